@@ -4,8 +4,11 @@ from gm_api import GMAPI
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-import time
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Часовой пояс дашборда - создаем один раз
+TZ_MSK = ZoneInfo("Europe/Moscow")
 
 def section_title(text):
     """Минималистичный заголовок секции"""
@@ -36,61 +39,208 @@ def draw_status_card(stats, details):
         with col_info:
             if key != "ok" and details[key]:
                 with st.popover("ℹ️"):
-                    for item in details[key]:
-                        st.markdown(f"• {item}")
+                    # Один markdown на весь список вместо элемента на каждую строку
+                    st.markdown("\n".join(f"- {item}" for item in details[key]))
             else:
                 st.markdown("<div class='status-row'></div>", unsafe_allow_html=True)
 
+@st.fragment
+def render_fuel_panel(fuel):
+    """
+    Панель топлива за вчера. Фрагмент: изменение цены топлива
+    перезапускает только эту панель, а не весь скрипт с загрузкой данных.
+    """
+    st.write("")  # Добавляем пространство
+
+    with st.container(border=True):
+        section_title("Топливо (Вчера)")
+
+        # Поле для ввода цены топлива
+        fuel_price = st.number_input(
+            "Цена топлива (₽/литр)",
+            min_value=0.0,
+            max_value=200.0,
+            value=63.0,
+            step=0.5,
+            help="Введите актуальную цену топлива для расчета финансовых показателей",
+            key="fuel_price_input"
+        )
+
+        # Пересчет стоимости на основе введенной цены
+        fillings_cost = fuel["fillings_vol"] * fuel_price
+        consumed_cost = fuel["consumed"] * fuel_price
+        drains_cost = fuel["drains_vol"] * fuel_price
+
+        st.write("")  # Пространство перед метриками
+
+        c1, c2, c3, c4 = st.columns(4)
+
+        with c1:
+            st.metric("Заправлено", f"{fuel['fillings_vol']:.1f} л", delta=fuel["fillings_trend"], help="Сравнение с позавчерашним днем")
+            st.caption(f"💰 {fillings_cost:,.0f} ₽")
+            st.caption(f"⛽ Заправок: {fuel['fillings_count']}")
+
+        with c2:
+            st.metric("Потрачено", f"{fuel['consumed']:.1f} л", delta=fuel["consumed_trend"], help="Сравнение с позавчерашним днем")
+            st.caption(f"💰 {consumed_cost:,.0f} ₽")
+
+        with c3:
+            st.metric("Слито (Потери)", f"{fuel['drains_vol']:.1f} л", delta=fuel["drains_trend"], delta_color="inverse", help="Сравнение с позавчерашним днем")
+            st.caption(f"💰 {drains_cost:,.0f} ₽")
+            st.caption(f"🚨 Сливов: {fuel['drains_count']}")
+
+        with c4:
+            st.metric("Процент потерь", f"{fuel['loss_pct']:.1f}%", delta=fuel["loss_pct_trend"], delta_color="inverse", help="Отношение объема сливов к объему заправок")
+
+def build_status_pie(labels, values, colors):
+    """Пирог статусов"""
+    fig = go.Figure(go.Pie(
+        labels=labels,
+        values=values,
+        hole=0.55,
+        marker=dict(colors=colors),
+        sort=False,
+        textinfo='percent',
+        hoverinfo='label+value+percent',
+        hovertemplate='%{label}: %{value} устройств (%{percent})<extra></extra>'
+    ))
+
+    total = sum(values)
+    fig.update_traces(textposition='inside', insidetextorientation='radial', pull=[0.02]*len(labels))
+    fig.update_layout(
+        showlegend=False,
+        margin=dict(t=20, b=10, l=10, r=10),
+        height=320,
+        annotations=[dict(
+            text=f"Всего<br><b>{total}</b>",
+            x=0.5, y=0.5,
+            font=dict(size=20, color='#333'),
+            showarrow=False
+        )]
+    )
+    return fig
+
 # === Кэшируемые функции загрузки данных ===
 
-@st.cache_data(ttl=300, show_spinner=False)
+@st.cache_resource(show_spinner=False)
+def last_good_store():
+    """Последние удачные ответы API - общие для всех сессий процесса"""
+    return {"lock": threading.Lock(), "items": {}}
+
+LAST_GOOD_MAX = 64  # сколько ответов держим про запас
+
+def with_last_good(fn, *args, future=None, complete=None):
+    """
+    Вызывает загрузчик и запоминает удачный результат в общем хранилище.
+    Если API недоступен - возвращает последний удачный ответ для тех же
+    аргументов и помечает его подписью об устаревших данных.
+    future - уже запущенный в фоне вызов fn(*args).
+    complete - проверка результата: неполный показываем, но про запас не сохраняем.
+    """
+    store = last_good_store()
+    key = (fn.__name__, args)
+    try:
+        result = future.result() if future else fn(*args)
+    except Exception:
+        with store["lock"]:
+            cached = store["items"].get(key)
+        if cached is None:
+            raise
+        st.caption("⚠️ API недоступен - данные могут быть устаревшими")
+        return cached
+    if complete and not complete(result):
+        return result
+    with store["lock"]:
+        items = store["items"]
+        items.pop(key, None)
+        items[key] = result
+        if len(items) > LAST_GOOD_MAX:
+            items.pop(next(iter(items)))
+    return result
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key):
+    """Один клиент GMAPI на ключ - переживает перезапуски скрипта"""
+    return GMAPI(api_key)
+
+@st.cache_data(ttl=3600, show_spinner=False) # Справочники меняются редко
 def load_trackers(api_key):
-    gm = GMAPI(api_key)
+    gm = get_client(api_key)
     return gm.get_trackers()
 
-@st.cache_data(ttl=300, show_spinner=False)
+@st.cache_data(ttl=30, show_spinner=False) # Состояния меняются быстро - короткий кэш
 def load_states(api_key, tracker_ids):
-    gm = GMAPI(api_key)
-    return gm.get_states(tracker_ids, list_blocked=True, allow_not_exist=True)
+    # tracker_ids - отсортированный tuple, чтобы ключ кэша был стабильным
+    gm = get_client(api_key)
+    return gm.get_states(list(tracker_ids), list_blocked=True, allow_not_exist=True)
 
-@st.cache_data(ttl=300, show_spinner=False)
+@st.cache_data(ttl=3600, show_spinner=False)
 def load_employees(api_key):
-    gm = GMAPI(api_key)
+    gm = get_client(api_key)
     return gm.get_employees()
 
-@st.cache_data(ttl=300, show_spinner=False)
+@st.cache_data(ttl=3600, show_spinner=False)
 def load_vehicles(api_key):
-    gm = GMAPI(api_key)
+    gm = get_client(api_key)
     return gm.get_vehicles()
 
-@st.cache_data(ttl=600, show_spinner=False) # Кэш на 10 минут для тяжелых поездок
+class IncompleteTrips(Exception):
+    """Часть трекеров не загрузилась - такой результат не кэшируем"""
+    def __init__(self, results):
+        super().__init__("Не все поездки загружены")
+        self.results = results
+
+class TripsUnavailable(Exception):
+    """Ни по одному трекеру поездки не загрузились - сбой API, а не пустой день"""
+    def __init__(self, results):
+        errors = sorted({item["error"] for item in results})
+        super().__init__("не удалось загрузить поездки: " + "; ".join(errors[:3]))
+
+# Даты закрытых дней входят в ключ кэша, поэтому TTL не нужен; max_entries ограничивает память
+@st.cache_data(ttl=None, max_entries=16, show_spinner=False)
+def load_trips_closed(api_key, tracker_ids, from_dt, to_dt):
+    gm = get_client(api_key)
+    results = gm.get_trips_parallel(list(tracker_ids), from_dt, to_dt)
+    if any(item["error"] for item in results):
+        raise IncompleteTrips(results)
+    return results
+
 def load_trips_stats(api_key, tracker_ids, from_dt, to_dt):
-    gm = GMAPI(api_key)
-    return gm.get_trips_parallel(tracker_ids, from_dt, to_dt)
+    try:
+        return load_trips_closed(api_key, tracker_ids, from_dt, to_dt)
+    except IncompleteTrips as e:
+        if all(item["error"] for item in e.results):
+            raise TripsUnavailable(e.results) from e
+        # Отдаем что есть, на следующем запуске попробуем загрузить заново
+        return e.results
+
+def trips_complete(results):
+    return not any(item["error"] for item in results)
+
+@st.cache_data(ttl=None, max_entries=16, show_spinner=False) # Отчет за закрытый день неизменен
+def load_fuel_report_closed(api_key, tracker_ids, from_dt, to_dt):
+    """
+    Генерация + ожидание + скачивание отчета по топливу.
+    Ошибки пробрасываются наружу, чтобы st.cache_data их не запоминал.
+    """
+    gm = get_client(api_key)
+    # 1. Генерация
+    gen_resp = gm.generate_fuel_report(list(tracker_ids), from_dt, to_dt)
+    report_id = gen_resp.get("id")
+
+    if not report_id:
+        raise RuntimeError("Не удалось получить ID отчета")
+
+    # 2. Ожидание (адаптивный поллинг клиента, не дольше 120 секунд)
+    gm.wait_for_report(report_id, timeout=120)
+
+    # 3. Скачивание
+    return gm.retrieve_report(report_id)
 
-@st.cache_data(ttl=1800, show_spinner=False) # Увеличим до 30 минут, отчеты по топливу не меняются часто
 def load_fuel_data(api_key, tracker_ids, from_dt, to_dt):
-    gm = GMAPI(api_key)
+    # Дашборд запрашивает топливо только за прошедшие дни (вчера/позавчера)
     try:
-        # 1. Генерация
-        gen_resp = gm.generate_fuel_report(tracker_ids, from_dt, to_dt)
-        report_id = gen_resp.get("id")
-        
-        if not report_id:
-            return {"error": "Не удалось получить ID отчета"}
-            
-        # 2. Ожидание (поллинг)
-        for _ in range(30): # Макс 60 секунд
-            status = gm.get_report_status(report_id)
-            if status.get("success") and status.get("percent_ready") == 100:
-                break
-            time.sleep(2)
-        else:
-            return {"error": "Таймаут создания отчета"}
-            
-        # 3. Скачивание
-        return gm.retrieve_report(report_id)
-        
+        return load_fuel_report_closed(api_key, tracker_ids, from_dt, to_dt)
     except Exception as e:
         return {"error": str(e)}
 
@@ -121,11 +271,27 @@ def parse_trip_report(report_json):
         pass
     return daily_stats
 
-@st.cache_data(ttl=1800, show_spinner=False) # Увеличим до 30 минут
+def build_daily_mileage(api_key, tracker_ids, from_dt, to_dt):
+    """Отчет по поездкам за период -> пробег по дням. Ошибки пробрасываются (не кэшируются)"""
+    gm = get_client(api_key)
+    report = gm.generate_trip_report(list(tracker_ids), from_dt, to_dt)
+    report_id = report.get("id")
+    if not report_id:
+        raise RuntimeError("Не удалось создать отчеты")
+
+    gm.wait_for_report(report_id)
+    return parse_trip_report(gm.retrieve_report(report_id))
+
+@st.cache_data(ttl=None, max_entries=8, show_spinner=False) # Прошедшая неделя уже не изменится
+def load_daily_mileage_closed(api_key, tracker_ids, from_dt, to_dt):
+    return build_daily_mileage(api_key, tracker_ids, from_dt, to_dt)
+
+@st.cache_data(ttl=1800, show_spinner=False) # Текущая неделя еще дополняется
+def load_daily_mileage_open(api_key, tracker_ids, from_dt, to_dt):
+    return build_daily_mileage(api_key, tracker_ids, from_dt, to_dt)
+
 def load_weekly_mileage(api_key, tracker_ids):
-    gm = GMAPI(api_key)
-    tz = ZoneInfo("Europe/Moscow")
-    today = datetime.now(tz).date()
+    today = datetime.now(TZ_MSK).date()
     
     # Current week (Mon-Sun)
     start_curr = today - timedelta(days=today.weekday())
@@ -143,30 +309,16 @@ def load_weekly_mileage(api_key, tracker_ids):
 
     range_prev_str = get_range_str(start_prev, end_prev)
     range_curr_str = get_range_str(start_curr, end_curr)
+    ids_key = tuple(sorted(tracker_ids))
     
     try:
-        # Generate reports
-        r_prev = gm.generate_trip_report(tracker_ids, range_prev_str[0], range_prev_str[1])
-        # Небольшая пауза между вызовами, чтобы не триггерить 429
-        time.sleep(2) 
-        r_curr = gm.generate_trip_report(tracker_ids, range_curr_str[0], range_curr_str[1])
-        
-        id_prev = r_prev.get("id")
-        id_curr = r_curr.get("id")
-        
-        if not id_prev or not id_curr:
-            return {"error": "Не удалось создать отчеты"}
-            
-        # Wait
-        gm.wait_for_report(id_prev)
-        gm.wait_for_report(id_curr)
-        
-        # Retrieve
-        data_prev = gm.retrieve_report(id_prev)
-        data_curr = gm.retrieve_report(id_curr)
-        
-        parsed_prev = parse_trip_report(data_prev)
-        parsed_curr = parse_trip_report(data_curr)
+        # Прошлая неделя почти всегда берется из кэша, генерируется только текущая.
+        # При холодном кэше отчеты независимы - строим оба параллельно
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            f_prev = ex.submit(load_daily_mileage_closed, api_key, ids_key, *range_prev_str)
+            f_curr = ex.submit(load_daily_mileage_open, api_key, ids_key, *range_curr_str)
+            parsed_prev = f_prev.result()
+            parsed_curr = f_curr.result()
         
         return {
             "prev": parsed_prev,
@@ -179,89 +331,74 @@ def load_weekly_mileage(api_key, tracker_ids):
     except Exception as e:
         return {"error": str(e)}
 
-def process_driver_licenses(employees):
-    today = datetime.now().date()
-    soon_limit = today + timedelta(days=30)
-
-    stats = {"ok": 0, "expiring": 0, "expired": 0, "empty": 0}
-    details = {"ok": [], "expiring": [], "expired": [], "empty": []}
-
-    for emp in employees:
-        name = f"{emp.get('first_name','')} {emp.get('last_name','')}".strip()
-        valid_till = emp.get("driver_license_valid_till")
-
-        if not valid_till:
-            stats["empty"] += 1
-            details["empty"].append(name)
-            continue
+def parse_iso_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
 
-        try:
-            # Пытаемся распарсить дату
-            dt = datetime.strptime(valid_till, "%Y-%m-%d").date()
-        except ValueError:
-            stats["empty"] += 1
-            details["empty"].append(name)
-            continue
-
-        if dt < today:
-            stats["expired"] += 1
-            details["expired"].append(name)
-        elif today <= dt < soon_limit:
-            stats["expiring"] += 1
-            details["expiring"].append(name)
-        else:
-            stats["ok"] += 1
-            details["ok"].append(name)
+def classify_expiry(names, valid_till, today):
+    """
+    Общая часть для ВУ и страховки: раскладывает элементы по сроку действия
+    на ok / expiring (меньше 30 дней) / expired / empty.
+    """
+    today_ts = pd.Timestamp(today)
+    soon_ts = today_ts + pd.Timedelta(days=30)
+
+    # Пустые и нераспознанные даты -> NaT
+    dt = pd.to_datetime(valid_till, format="%Y-%m-%d", errors="coerce")
+
+    masks = {
+        "empty": dt.isna(),
+        "expired": dt < today_ts,
+        "expiring": (dt >= today_ts) & (dt < soon_ts),
+    }
+
+    # NaT дают и даты вне диапазона pandas (1677-2262) - заглушки вроде "9999-12-31".
+    # Таких строк единицы, досчитываем их через strptime, как раньше
+    wide = valid_till[masks["empty"]].map(parse_iso_date).dropna()
+    if not wide.empty:
+        soon_date = soon_ts.date()
+        masks["empty"].loc[wide.index] = False
+        masks["expired"].loc[wide.index] = wide < today
+        masks["expiring"].loc[wide.index] = (wide >= today) & (wide < soon_date)
+    masks["ok"] = ~(masks["empty"] | masks["expired"] | masks["expiring"])
+
+    keys = ("ok", "expiring", "expired", "empty")
+    stats = {k: int(masks[k].sum()) for k in keys}
+    details = {k: names[masks[k]].tolist() for k in keys}
 
     return stats, details
 
-def process_insurance(vehicles):
-    today = datetime.now().date()
-    soon_limit = today + timedelta(days=30)
-
-    stats = {"ok": 0, "expiring": 0, "expired": 0, "empty": 0}
-    details = {"ok": [], "expiring": [], "expired": [], "empty": []}
-
-    for v in vehicles:
-        name = v.get("label", "Без названия")
-        reg = v.get("reg_number", "")
-        item = f"{name} — {reg}" if reg else name
-
-        osago = v.get("liability_insurance_valid_till")
-        kasko = v.get("free_insurance_valid_till")
-        valid_till = osago or kasko
-
-        if not valid_till:
-            stats["empty"] += 1
-            details["empty"].append(item)
-            continue
-
-        try:
-            dt = datetime.strptime(valid_till, "%Y-%m-%d").date()
-        except ValueError:
-            stats["empty"] += 1
-            details["empty"].append(item)
-            continue
-
-        if dt < today:
-            stats["expired"] += 1
-            details["expired"].append(item)
-        elif today <= dt < soon_limit:
-            stats["expiring"] += 1
-            details["expiring"].append(item)
-        else:
-            stats["ok"] += 1
-            details["ok"].append(item)
-
-    return stats, details
+# Чистые функции от входных данных: на перезапусках (например, смена цены топлива)
+# не пересчитываются. today входит в ключ кэша, чтобы статусы сменились в полночь
+@st.cache_data(max_entries=16, show_spinner=False)
+def process_driver_licenses(employees, today):
+    df = pd.DataFrame(employees).reindex(columns=["first_name", "last_name", "driver_license_valid_till"])
+    names = (df["first_name"].fillna("").astype(str) + " " + df["last_name"].fillna("").astype(str)).str.strip()
+    return classify_expiry(names, df["driver_license_valid_till"], today)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def process_insurance(vehicles, today):
+    df = pd.DataFrame(vehicles).reindex(columns=[
+        "label", "reg_number", "liability_insurance_valid_till", "free_insurance_valid_till"
+    ])
+    name = df["label"].fillna("Без названия").astype(str)
+    reg = df["reg_number"].fillna("").astype(str)
+    items = name.where(reg == "", name + " — " + reg)
+
+    # ОСАГО, если заполнено, иначе КАСКО
+    osago = df["liability_insurance_valid_till"]
+    valid_till = osago.where(osago.notna() & (osago != ""), df["free_insurance_valid_till"])
+    return classify_expiry(items, valid_till, today)
 
 
 # === Настройки страницы ===
 st.set_page_config(page_title="GM API Dashboard", layout="wide")
 
 # === Получаем API ключ из URL ===
-query_params = st.query_params
-api_key = query_params.get("session_key", [None])[0] if isinstance(query_params.get("session_key"), list) else query_params.get("session_key")
+# st.query_params возвращает значение параметра строкой
+api_key = st.query_params.get("session_key")
 
 if not api_key:
     st.error("❌ В ссылке не найден параметр `session_key`. Добавьте его в URL, например: ?session_key=hash")
@@ -278,11 +415,11 @@ st.markdown(
 )
 
 # === Подключаемся к API ===
-gm = GMAPI(api_key)
+gm = get_client(api_key)
 
 # === Получаем список трекеров (Кэшировано) ===
 try:
-    data = load_trackers(api_key)
+    data = with_last_good(load_trackers, api_key)
 except Exception as e:
     st.error(f"Ошибка при загрузке списка трекеров: {e}")
     st.stop()
@@ -296,9 +433,17 @@ tracker_ids = [int(t["id"]) for t in trackers]
 
 # === Блок 1: Верхняя часть (Статусы, Права, Страховка) - Грузится быстро ===
 
+# Состояния, водители и ТС не зависят друг от друга - грузим параллельно
+state_ids = tuple(sorted(tracker_ids))
+prefetch = ThreadPoolExecutor(max_workers=3)
+f_states = prefetch.submit(load_states, api_key, state_ids)
+f_employees = prefetch.submit(load_employees, api_key)
+f_vehicles = prefetch.submit(load_vehicles, api_key)
+prefetch.shutdown(wait=False)
+
 # Получаем состояния (Кэшировано)
 try:
-    states_response = load_states(api_key, tracker_ids)
+    states_response = with_last_good(load_states, api_key, state_ids, future=f_states)
     states = states_response.get("states", {})
 except Exception as e:
     st.error(f"Ошибка при получении состояний трекеров: {e}")
@@ -313,7 +458,12 @@ counters = {
     "Не в сети": 0
 }
 
-status_norm_map = {
+class IdentityDict(dict):
+    """dict, который для неизвестного ключа возвращает сам ключ"""
+    def __missing__(self, key):
+        return key
+
+status_norm_map = IdentityDict({
     "В движении": "Едет",
     "Едет": "Едет",
     "Стоит": "Стоит",
@@ -321,27 +471,38 @@ status_norm_map = {
     "Холостой ход": "Холостой ход",
     "Нет координат": "Нет координат",
     "Не в сети": "Не в сети",
-}
+})
 
-for tid, state in states.items():
-    raw_status = gm.get_tracker_status(state)
-    canon = status_norm_map.get(raw_status, raw_status)
-    counters[canon] = counters.get(canon, 0) + 1
+get_status = gm.get_tracker_status  # метод ищем один раз, а не на каждый трекер
+raw_statuses = pd.Series([get_status(s) for s in states.values()], dtype="string")
+# Series.map использует __missing__ - неизвестные статусы остаются как есть без fillna
+canon_statuses = raw_statuses.map(status_norm_map)
+status_counts = canon_statuses.value_counts()
+# Канонический порядок сохраняется, неизвестные статусы добавляются в конец
+counters = counters | {k: int(v) for k, v in status_counts.items()}
 
 # Визуализация пирога
-labels, values = [], []
-for k, v in counters.items():
-    if v > 0:
-        labels.append(k)
-        values.append(v)
+pie_items = [(k, v) for k, v in counters.items() if v > 0]
+labels, values = zip(*pie_items) if pie_items else ((), ())
 
 # === Создание вкладок (через Radio для Lazy Loading) ===
-selected_tab = st.radio(
-    "Навигация", 
-    ["Основная", "Идеи"], 
-    horizontal=True, 
-    label_visibility="collapsed"
-)
+nav_col, refresh_col = st.columns([5, 1])
+with nav_col:
+    selected_tab = st.radio(
+        "Навигация", 
+        ["Основная", "Идеи"], 
+        horizontal=True, 
+        label_visibility="collapsed"
+    )
+with refresh_col:
+    # Ручной сброс кэша - только быстрые загрузчики и только для своего ключа.
+    # Отчеты за закрытые дни неизменны, а строятся до 2 минут - их не трогаем
+    if st.button("🔄 Обновить", use_container_width=True):
+        load_trackers.clear(api_key)
+        load_states.clear(api_key, state_ids)
+        load_employees.clear(api_key)
+        load_vehicles.clear(api_key)
+        st.rerun()
 
 # === Заполнение вкладок ===
 
@@ -363,34 +524,10 @@ if selected_tab == "Основная":
                     "Нет координат": "#9ca3af",
                     "Не в сети": "#ef4444"
                 }
-                colors = [status_colors.get(lbl, "#CCCCCC") for lbl in labels]
-
-                fig = go.Figure(go.Pie(
-                    labels=labels,
-                    values=values,
-                    hole=0.55,
-                    marker=dict(colors=colors),
-                    sort=False,
-                    textinfo='percent',
-                    hoverinfo='label+value+percent',
-                    hovertemplate='%{label}: %{value} устройств (%{percent})<extra></extra>'
-                ))
-
-                total = sum(values)
-                fleet_total = total
-                fig.update_traces(textposition='inside', insidetextorientation='radial', pull=[0.02]*len(labels))
-                fig.update_layout(
-                    showlegend=False,
-                    margin=dict(t=20, b=10, l=10, r=10),
-                    height=320,
-                    annotations=[dict(
-                        text=f"Всего<br><b>{total}</b>",
-                        x=0.5, y=0.5,
-                        font=dict(size=20, color='#333'),
-                        showarrow=False
-                    )]
-                )
-                st.plotly_chart(fig, use_container_width=True, config={"displayModeBar": False})
+                colors = pd.Series(labels).map(status_colors).fillna("#CCCCCC").tolist()
+
+                fig = build_status_pie(labels, values, colors)
+                st.plotly_chart(fig, use_container_width=True, config={"displayModeBar": False}, key="status_pie")
 
 elif selected_tab == "Идеи":
     ic1, ic2, ic3 = st.columns(3)
@@ -400,7 +537,7 @@ elif selected_tab == "Идеи":
         with st.container(border=True):
             section_title("Водительские удостоверения")
             try:
-                employees_data = load_employees(api_key)
+                employees_data = with_last_good(load_employees, api_key, future=f_employees)
                 employees = employees_data.get("list", [])
             except Exception as e:
                 st.error(f"Ошибка: {e}")
@@ -409,7 +546,7 @@ elif selected_tab == "Идеи":
             if not employees:
                 st.warning("⚠️ Данные отсутствуют - заполните раздел Водители")
             else:
-                vu_stats, vu_details = process_driver_licenses(employees)
+                vu_stats, vu_details = process_driver_licenses(employees, datetime.now().date())
                 draw_status_card(vu_stats, vu_details)
 
     # 3. Страховка (Ideas - Col 2)
@@ -417,7 +554,7 @@ elif selected_tab == "Идеи":
         with st.container(border=True):
             section_title("Страховка")
             try:
-                vehicles_data = load_vehicles(api_key)
+                vehicles_data = with_last_good(load_vehicles, api_key, future=f_vehicles)
                 vehicles = vehicles_data.get("list", [])
             except Exception as e:
                 st.error(f"Ошибка: {e}")
@@ -426,15 +563,14 @@ elif selected_tab == "Идеи":
             if not vehicles:
                 st.warning("⚠️ Данные отсутствуют - заполните раздел Транспорт")
             else:
-                insurance_stats, insurance_details = process_insurance(vehicles)
+                insurance_stats, insurance_details = process_insurance(vehicles, datetime.now().date())
                 draw_status_card(insurance_stats, insurance_details)
 
 
 # === БЛОК 2: Тяжелые данные (Поездки) ===
 
 # Функция для расчета дат с учетом таймзоны
-def get_day_range_ts(date_obj, tz_name="Europe/Moscow"):
-    tz = ZoneInfo(tz_name)
+def get_day_range_ts(date_obj, tz=TZ_MSK):
     # Начало дня в локальной зоне
     start_local = datetime.combine(date_obj, datetime.min.time()).replace(tzinfo=tz)
     # Конец дня
@@ -445,8 +581,7 @@ def get_day_range_ts(date_obj, tz_name="Europe/Moscow"):
     return start_local.strftime(fmt), end_local.strftime(fmt)
 
 # Локальные даты
-tz_msk = ZoneInfo("Europe/Moscow")
-now_msk = datetime.now(tz_msk)
+now_msk = datetime.now(TZ_MSK)
 today = now_msk.date()
 yesterday = today - timedelta(days=1)
 day_before = today - timedelta(days=2)
@@ -456,112 +591,108 @@ from_dt, _ = get_day_range_ts(day_before)
 _, to_dt = get_day_range_ts(yesterday)
 
 # === Оптимизация: Фильтруем трекеры, которые давно не обновлялись ===
-active_tracker_ids = []
-# Парсим дату начала периода для сравнения
-try:
-    period_start_dt = datetime.strptime(from_dt, "%Y-%m-%d %H:%M:%S").replace(tzinfo=ZoneInfo("Europe/Moscow"))
-except:
-    period_start_dt = None
-
-if period_start_dt:
-    for tid in tracker_ids:
-        state_obj = states.get(tid, {})
-        # last_update может быть в state_obj или внутри state_obj["state"]
-        # Обычно это поле "last_update" (строка)
-        s = state_obj.get("state", state_obj)
-        last_upd_str = s.get("last_update")
-        
-        if not last_upd_str:
-            # Если нет даты обновления, на всякий случай берем
-            active_tracker_ids.append(tid)
-            continue
-            
-        try:
-            # Формат обычно "YYYY-MM-DD HH:MM:SS"
-            # Предполагаем, что API возвращает время в UTC или локальное. 
-            # Для надежности просто сравниваем строки (YYYY-MM-DD) или парсим
-            lu_dt = datetime.strptime(last_upd_str, "%Y-%m-%d %H:%M:%S").replace(tzinfo=ZoneInfo("Europe/Moscow"))
-            
-            # Если последнее обновление было ПОЗЖЕ начала периода (с запасом 1 день), берем
-            # Или если оно было ХОТЯ БЫ в этом периоде
-            if lu_dt >= period_start_dt - timedelta(days=1):
-                active_tracker_ids.append(tid)
-        except:
-            # Если ошибка парсинга, берем
-            active_tracker_ids.append(tid)
-else:
-    active_tracker_ids = tracker_ids
+# Начало периода для сравнения: from_dt мы форматируем сами, fromisoformat
+# понимает "YYYY-MM-DD HH:MM:SS" с Python 3.7
+period_start_dt = datetime.fromisoformat(from_dt).replace(tzinfo=TZ_MSK)
+
+def get_last_update(state_obj):
+    # last_update может быть в state_obj или внутри state_obj["state"]
+    s = state_obj.get("state", state_obj) or {}
+    return s.get("last_update") or None
+
+# Формат "YYYY-MM-DD HH:MM:SS" сортируется как строка - strptime не нужен
+last_updates = pd.Series(
+    [get_last_update(states.get(tid, {})) for tid in tracker_ids],
+    index=tracker_ids,
+    dtype="string"
+)
+cutoff = (period_start_dt - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+
+# Если нет даты обновления, на всякий случай берем.
+# Если последнее обновление было ПОЗЖЕ начала периода (с запасом 1 день), берем
+active_mask = last_updates.isna() | (last_updates >= cutoff).fillna(False)
+active_tracker_ids = last_updates.index[active_mask.to_numpy(dtype=bool)].tolist()
+
+# === Топливо: запускаем отчеты заранее, чтобы они строились пока грузятся поездки ===
+fuel_futures = None
+if selected_tab == "Идеи" and active_tracker_ids:
+    # Даты для вчера и позавчера
+    f_start_y, f_end_y = get_day_range_ts(yesterday)
+    f_start_db, f_end_db = get_day_range_ts(day_before)
+
+    fuel_ids = tuple(sorted(active_tracker_ids))
+    fuel_executor = ThreadPoolExecutor(max_workers=2)
+    fuel_futures = (
+        fuel_executor.submit(load_fuel_data, api_key, fuel_ids, f_start_y, f_end_y),
+        fuel_executor.submit(load_fuel_data, api_key, fuel_ids, f_start_db, f_end_db),
+    )
+    fuel_executor.shutdown(wait=False)
 
 # === ЗАГРУЗКА ПОЕЗДОК ===
-with st.spinner(f"Загрузка истории поездок ({len(active_tracker_ids)} из {len(tracker_ids)} активных)..."):
+if not active_tracker_ids:
+    # Запрос с пустым списком трекеров ничего не вернет - не делаем его
+    two_days_trips = []
+    st.info("Нет активных трекеров за период")
+else:
+    trips_args = (api_key, tuple(sorted(active_tracker_ids)), from_dt, to_dt)
+
+    # Грузим в основном потоке: перезапуск скрипта может прервать загрузку.
+    # Статус убираем до with_last_good, чтобы его подписи остались на странице
+    trips_call = Future()
+    status_slot = st.empty()
+    with status_slot.status(
+        f"Загрузка истории поездок ({len(active_tracker_ids)} из {len(tracker_ids)} активных)..."
+    ):
+        try:
+            trips_call.set_result(load_trips_stats(*trips_args))
+        except Exception as e:
+            trips_call.set_exception(e)
+    status_slot.empty()
+
     try:
-        two_days_trips = load_trips_stats(api_key, active_tracker_ids, from_dt, to_dt)
+        two_days_trips = with_last_good(
+            load_trips_stats, *trips_args, future=trips_call, complete=trips_complete
+        )
+    except TripsUnavailable as e:
+        # Ни один трекер не ответил и сохраненной копии нет
+        st.error(f"Ошибка API: {e}")
+        st.stop()
     except Exception as e:
         st.error(f"Не удалось получить данные о поездках: {e}")
         st.stop()
 
+    if not trips_complete(two_days_trips):
+        failed = sum(1 for item in two_days_trips if item["error"])
+        st.warning(f"Не все поездки загружены: нет данных по {failed} из {len(two_days_trips)} трекеров")
+
 # --- Обработка данных (быстро, в памяти) ---
 yesterday_str = yesterday.strftime("%Y-%m-%d")
 day_before_str = day_before.strftime("%Y-%m-%d")
 
-yesterday_trips = []
-day_before_trips = []
-
-for item in two_days_trips:
-    tid = item["id"]
-    trips = item["trips"]
+# Все поездки за 2 дня одной таблицей; день берем из первых 10 символов start_date (YYYY-MM-DD)
+all_trips = pd.DataFrame(
+    [dict(tr, tid=item["id"]) for item in two_days_trips for tr in item["trips"]]
+).reindex(columns=["tid", "start_date", "end_date", "length", "duration", "idle_duration"])
+trip_day = all_trips["start_date"].fillna("").astype(str).str.slice(0, 10)
 
-    y_list = []
-    db_list = []
-
-    for tr in trips:
-        start_str = tr.get("start_date") # "2025-11-16 10:00:00"
-        if not start_str:
-            continue
-        
-        # API возвращает дату как строку, берем первые 10 символов (YYYY-MM-DD)
-        trip_date = start_str[:10]
-
-        if trip_date == yesterday_str:
-            y_list.append(tr)
-        elif trip_date == day_before_str:
-            db_list.append(tr)
-
-    yesterday_trips.append({"id": tid, "trips": y_list})
-    day_before_trips.append({"id": tid, "trips": db_list})
+trips_df = all_trips[trip_day == yesterday_str]
+day_before_df = all_trips[trip_day == day_before_str]
 
 # --- KPI расчёты ---
-active_count = sum(1 for t in yesterday_trips if len(t["trips"]) > 0)
-prev_active_count = sum(1 for t in day_before_trips if len(t["trips"]) > 0)
+active_count = trips_df["tid"].nunique()
+prev_active_count = day_before_df["tid"].nunique()
 
-total_distance = 0.0
-total_move_time = 0
-total_idle_time = 0
+total_distance = float(pd.to_numeric(trips_df["length"], errors="coerce").fillna(0).sum())
 
-for item in yesterday_trips:
-    for tr in item["trips"]:
-        total_distance += float(tr.get("length", 0) or 0)
-        
-        # Расчет времени в пути (через разницу дат)
-        s_str = tr.get("start_date")
-        e_str = tr.get("end_date")
-        if s_str and e_str:
-            try:
-                s_dt = datetime.strptime(s_str, "%Y-%m-%d %H:%M:%S")
-                e_dt = datetime.strptime(e_str, "%Y-%m-%d %H:%M:%S")
-                dur = (e_dt - s_dt).total_seconds()
-                if dur > 0:
-                    total_move_time += dur
-            except:
-                # Если не удалось распарсить, пробуем взять поле duration, если оно есть
-                total_move_time += (tr.get("duration") or 0)
-        else:
-             total_move_time += (tr.get("duration") or 0)
+# Время в пути через разницу дат; если даты не распарсились - берем поле duration
+trip_start = pd.to_datetime(trips_df["start_date"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+trip_end = pd.to_datetime(trips_df["end_date"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+fallback_duration = pd.to_numeric(trips_df["duration"], errors="coerce").fillna(0)
+move_time = (trip_end - trip_start).dt.total_seconds().clip(lower=0).fillna(fallback_duration)
+total_move_time = float(move_time.sum())
 
-        # Холостой ход (idle_duration)
-        idle_sec = tr.get("idle_duration") or 0
-        if isinstance(idle_sec, (int, float)):
-            total_idle_time += idle_sec
+# Холостой ход (idle_duration)
+total_idle_time = float(pd.to_numeric(trips_df["idle_duration"], errors="coerce").fillna(0).sum())
 
 def fmt_time(seconds):
     if not seconds or seconds <= 0:
@@ -640,7 +771,7 @@ if selected_tab == "Основная":
             p_start = weekly_data["dates"]["prev_start"]
             c_start = weekly_data["dates"]["curr_start"]
             
-            today_date = datetime.now(ZoneInfo("Europe/Moscow")).date()
+            today_date = datetime.now(TZ_MSK).date()
             
             p_vals, p_dates = [], []
             c_vals, c_dates = [], []
@@ -687,7 +818,7 @@ if selected_tab == "Основная":
                 yaxis=dict(title="Км"),
                 xaxis=dict(title="")
             )
-            st.plotly_chart(fig_w, use_container_width=True, config={"displayModeBar": False})
+            st.plotly_chart(fig_w, use_container_width=True, config={"displayModeBar": False}, key="weekly_mileage_chart")
 
 # === Вывод метрик (Ideas) ===
 elif selected_tab == "Идеи":
@@ -707,22 +838,15 @@ elif selected_tab == "Идеи":
     fuel_container = st.container()
 
     with st.spinner("Загрузка данных по топливу..."):
-        # Даты для вчера и позавчера
-        f_start_y, f_end_y = get_day_range_ts(yesterday)
-        f_start_db, f_end_db = get_day_range_ts(day_before)
-        
         # Проверка на наличие активных трекеров
-        if not active_tracker_ids:
+        if not fuel_futures:
             fuel_report_y = None
             fuel_report_db = None
         else:
-            # Запускаем параллельно
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                future_y = executor.submit(load_fuel_data, api_key, active_tracker_ids, f_start_y, f_end_y)
-                future_db = executor.submit(load_fuel_data, api_key, active_tracker_ids, f_start_db, f_end_db)
-                
-                fuel_data_y = future_y.result()
-                fuel_data_db = future_db.result()
+            # Отчеты запущены до загрузки поездок - здесь только дожидаемся
+            future_y, future_db = fuel_futures
+            fuel_data_y = future_y.result()
+            fuel_data_db = future_db.result()
             
             # Проверяем ошибки (хотя бы за вчера должно загрузиться)
             if "error" in fuel_data_y:
@@ -825,47 +949,18 @@ elif selected_tab == "Идеи":
                 
             # Визуализация
             with fuel_container:
-                st.write("")  # Добавляем пространство
-                
-                with st.container(border=True):
-                    section_title("Топливо (Вчера)")
-                    
-                    # Поле для ввода цены топлива
-                    fuel_price = st.number_input(
-                        "Цена топлива (₽/литр)",
-                        min_value=0.0,
-                        max_value=200.0,
-                        value=63.0,
-                        step=0.5,
-                        help="Введите актуальную цену топлива для расчета финансовых показателей",
-                        key="fuel_price_input"
-                    )
-                    
-                    # Пересчет стоимости на основе введенной цены
-                    fillings_cost = fillings_vol * fuel_price
-                    consumed_cost = consumed * fuel_price
-                    drains_cost = drains_vol * fuel_price
-                    
-                    st.write("")  # Пространство перед метриками
-                    
-                    c1, c2, c3, c4 = st.columns(4)
-                    
-                    with c1:
-                        st.metric("Заправлено", f"{fillings_vol:.1f} л", delta=trend_str, help="Сравнение с позавчерашним днем")
-                        st.caption(f"💰 {fillings_cost:,.0f} ₽")
-                        st.caption(f"⛽ Заправок: {fillings_count}")
-                        
-                    with c2:
-                        st.metric("Потрачено", f"{consumed:.1f} л", delta=consumed_trend_str, help="Сравнение с позавчерашним днем")
-                        st.caption(f"💰 {consumed_cost:,.0f} ₽")
-                        
-                    with c3:
-                        st.metric("Слито (Потери)", f"{drains_vol:.1f} л", delta=drains_trend_str, delta_color="inverse", help="Сравнение с позавчерашним днем")
-                        st.caption(f"💰 {drains_cost:,.0f} ₽")
-                        st.caption(f"🚨 Сливов: {drains_count}")
-                        
-                    with c4:
-                        st.metric("Процент потерь", f"{loss_pct:.1f}%", delta=loss_pct_trend_str, delta_color="inverse", help="Отношение объема сливов к объему заправок")
+                render_fuel_panel({
+                    "fillings_vol": fillings_vol,
+                    "fillings_count": fillings_count,
+                    "drains_vol": drains_vol,
+                    "drains_count": drains_count,
+                    "consumed": consumed,
+                    "loss_pct": loss_pct,
+                    "fillings_trend": trend_str,
+                    "consumed_trend": consumed_trend_str,
+                    "drains_trend": drains_trend_str,
+                    "loss_pct_trend": loss_pct_trend_str,
+                })
     
         except Exception as e:
             st.error(f"Ошибка обработки отчета: {e}")
@@ -1,41 +1,153 @@
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 import time
+import random
 import logging
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Логирование настраивает приложение; без настройки WARNING+ все равно уходят в stderr
 logger = logging.getLogger(__name__)
 
+# Сколько трекеров отправляем в одном запросе get_states
+STATES_CHUNK = 200
+
+# Повторы запросов: экспоненциальная пауза со случайным разбросом.
+# Остальные 4xx (неверный hash, параметры) повтором не исправить - падаем сразу
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_JITTER = 0.5
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов: до capacity запросов подряд, дальше rate в секунду.
+    На 429 скорость падает вдвое, на успехах понемногу возвращается к исходной (AIMD).
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        with self.cond:
+            self._refill()
+            while self.tokens < 1:
+                # wait отпускает блокировку - другие потоки тоже могут ждать свой токен
+                self.cond.wait((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def penalize(self):
+        with self.cond:
+            self._refill()
+            self.rate = max(self.max_rate / 8, self.rate / 2)
+
+    def reward(self):
+        with self.cond:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
 class GMAPI:
     def __init__(self, api_key: str):
         self.base_url = "https://my.gdemoi.ru/api-v2"
         self.api_key = api_key
+        # Постоянная сессия: keep-alive и пул соединений вместо нового TCP/TLS на каждый вызов.
+        # pool_maxsize не меньше потоков в get_trips_parallel
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=25)
+        self.session.mount("https://", adapter)
+        # Генерация отчетов: в среднем не чаще раза в 1.5 с, короткие пачки до 3 без ожидания
+        self.report_bucket = TokenBucket(rate=1 / 1.5, capacity=3)
+
+    @staticmethod
+    def _json(response):
+        """Разбор ответа через orjson - заметно быстрее stdlib json на больших отчетах"""
+        return orjson.loads(response.content)
+
+    @staticmethod
+    def _retry_delay(attempt: int, response=None):
+        """Пауза перед повтором: Retry-After от сервера или 2^attempt с jitter"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(RETRY_MAX_DELAY, float(retry_after))
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+        return delay * (1 + random.uniform(0, RETRY_JITTER))
+
+    def _request_with_retry(self, method: str, url: str, max_retries: int = 3, limiter=None, **kwargs):
+        """
+        Запрос с повторами при 429/5xx и сетевых ошибках.
+        Jitter разводит повторы параллельных потоков, чтобы они не били в API пачкой.
+        limiter - TokenBucket: токен берет только первая попытка, повторы уже
+        выдержаны backoff/Retry-After. 429 замедляет bucket.
+        """
+        for attempt in range(max_retries):
+            last_attempt = attempt == max_retries - 1
+            if limiter and attempt == 0:
+                limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                if last_attempt:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning("%s %s failed (%s). Retrying in %.1fs... (Attempt %d/%d)",
+                               method, url, e, delay, attempt + 1, max_retries)
+            else:
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    if response.status_code >= 400:
+                        raise requests.HTTPError(
+                            f"{method} {url} failed: {response.status_code} {response.text[:200]}",
+                            response=response
+                        )
+                    if limiter:
+                        limiter.reward()
+                    return self._json(response)
+                if limiter and response.status_code == 429:
+                    limiter.penalize()
+                delay = self._retry_delay(attempt, response)
+                logger.warning("%s %s returned %d. Retrying in %.1fs... (Attempt %d/%d)",
+                               method, url, response.status_code, delay, attempt + 1, max_retries)
+            time.sleep(delay)
 
     def get_trackers(self):
         """Получаем список трекеров пользователя"""
         url = f"{self.base_url}/tracker/list"
         params = {"hash": self.api_key}
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()
-        return response.json()
+        return self._json(response)
     
     def get_tracker_readings(self, tracker_id: int):
         """Получает показания сенсоров по определенному трекеру"""
         url = f"{self.base_url}/tracker/readings/list"
         params = {"hash": self.api_key, "tracker_id": tracker_id}
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()
-        return response.json()
+        return self._json(response)
     
     def get_tracker_readings_batch(self, tracker_ids: list[int]):
         """Получает показания сенсоров сразу по нескольким трекерам"""
         url = f"{self.base_url}/tracker/readings/batch_list"
         payload = {"hash": self.api_key, "tracker_ids": tracker_ids}
-        response = requests.post(url, json=payload)
+        response = self.session.post(url, json=payload)
         response.raise_for_status()
-        return response.json()
+        return self._json(response)
     
     def get_sensor_data(self, tracker_id: int, sensor_id: int, from_ts: str, to_ts: str, raw_data: bool=False):
         """Исторические данные датчиков - сырые данные"""
@@ -48,12 +160,34 @@ class GMAPI:
         "to": to_ts,
         "raw_data": str(raw_data).lower()
         }
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()
-        return response.json()
+        return self._json(response)
     
     def get_states(self, tracker_ids: list[int], list_blocked: bool=False, allow_not_exist: bool=False):
         """Текущее состояние нескольких трекеров"""
+        if len(tracker_ids) <= STATES_CHUNK:
+            return self._get_states_one(tracker_ids, list_blocked, allow_not_exist)
+
+        # Большой парк: несколько запросов поменьше параллельно вместо одного огромного
+        chunks = [tracker_ids[i:i + STATES_CHUNK] for i in range(0, len(tracker_ids), STATES_CHUNK)]
+        with ThreadPoolExecutor(max_workers=min(8, len(chunks))) as executor:
+            parts = list(executor.map(
+                lambda c: self._get_states_one(c, list_blocked, allow_not_exist), chunks
+            ))
+
+        # Склеиваем ответы: словари (states) объединяем, списки (blocked, not_exist) сцепляем
+        merged = dict(parts[0])
+        for part in parts[1:]:
+            for key, value in part.items():
+                if isinstance(value, dict):
+                    merged[key] = {**merged.get(key, {}), **value}
+                elif isinstance(value, list):
+                    merged[key] = merged.get(key, []) + value
+        return merged
+
+    def _get_states_one(self, tracker_ids: list[int], list_blocked: bool, allow_not_exist: bool):
+        """Один запрос get_states без разбиения"""
         url = f"{self.base_url}/tracker/get_states"
         payload = {
             "hash": self.api_key,
@@ -61,9 +195,19 @@ class GMAPI:
             "list_blocked": list_blocked,
             "allow_not_exist": allow_not_exist
         }
-        r = requests.post(url, json=payload, timeout=30)
+        r = self.session.post(url, json=payload, timeout=30)
         r.raise_for_status()
-        return r.json()
+        return self._json(r)
+
+    # (connection_status, movement_status, ignition) -> статус
+    _STATUS_TABLE = {
+        ("active", "parked", False): "Стоит",
+        ("active", "parked", True): "Стоит с включенным зажиганием",
+        ("active", "moving", False): "В движении",
+        ("active", "moving", True): "В движении",
+        ("active", "stopped", False): "В движении",
+        ("active", "stopped", True): "В движении",
+    }
 
     def get_tracker_status(self, state_obj):
         """
@@ -80,43 +224,30 @@ class GMAPI:
         s = state_obj.get("state", state_obj)
         conn = (s.get("connection_status") or "").lower()
         move = (s.get("movement_status") or "").lower()
-        ignition = s.get("ignition", False)
-
-        # --- Не в сети ---
-        offline_statuses = {"offline", "signal_lost", "just_registered", "just_replaced"}
-        if conn in offline_statuses or not conn:
-            return "Не в сети"
 
         # --- Нет координат ---
         if conn == "idle":
             return "Нет координат"
 
-        # --- Стоит / Стоит с включенным зажиганием ---
-        if conn == "active" and move == "parked":
-            return "Стоит с включенным зажиганием" if ignition else "Стоит"
-
-        # --- В движении ---
-        if conn == "active" and move in ("moving", "stopped"):
-            return "В движении"
-
-        # --- fallback ---
-        return "Не в сети"
+        # Офлайн-статусы и пустой connection_status в таблицу не входят -> "Не в сети"
+        key = (conn, move, bool(s.get("ignition", False)))
+        return self._STATUS_TABLE.get(key, "Не в сети")
     
     def get_employees(self):
         """Получаем список сотрудников / водителей"""
         url = f"{self.base_url}/employee/list"
         params = {"hash": self.api_key}
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()
-        return response.json()
+        return self._json(response)
     
     def get_vehicles(self):
         """Получаем список ТС для ОСАГО/КАСКО"""
         url = f"{self.base_url}/vehicle/list"
         params = {"hash": self.api_key}
-        response = requests.get(url, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()
-        return response.json()
+        return self._json(response)
 
     def get_trips(self, tracker_id: int, from_dt: str, to_dt: str):
         """Поездки трекера за период (POST /track/list)"""
@@ -130,9 +261,7 @@ class GMAPI:
             "count_events": True
         }
         # Используем POST и json=payload
-        response = requests.post(url, json=payload, timeout=30)
-        response.raise_for_status()
-        return response.json()
+        return self._request_with_retry("POST", url, json=payload, timeout=30)
     
     
 
@@ -144,20 +273,18 @@ class GMAPI:
         results = []
 
         def fetch_one(tid):
-            # Простая логика повторных попыток (retries)
-            attempts = 3
-            for attempt in range(attempts):
-                try:
-                    data = self.get_trips(tid, from_dt, to_dt)
-                    return {"id": tid, "trips": data.get("list", []), "error": None}
-                except Exception as e:
-                    if attempt == attempts - 1:
-                        logger.error(f"Failed to fetch trips for tracker {tid}: {e}")
-                        return {"id": tid, "trips": [], "error": str(e)}
-                    time.sleep(1) # Пауза перед повтором
+            # Повторы при 429/5xx уже внутри get_trips
+            try:
+                data = self.get_trips(tid, from_dt, to_dt)
+                return {"id": tid, "trips": data.get("list", []), "error": None}
+            except Exception as e:
+                logger.error("Failed to fetch trips for tracker %s: %s", tid, e)
+                return {"id": tid, "trips": [], "error": str(e)}
 
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_id = {executor.submit(fetch_one, tid): tid for tid in tracker_ids}
+            # Дубликаты ID дали бы одинаковые запросы к /track/list
+            unique_ids = list(dict.fromkeys(tracker_ids))
+            future_to_id = {executor.submit(fetch_one, tid): tid for tid in unique_ids}
             for future in as_completed(future_to_id):
                 results.append(future.result())
 
@@ -166,29 +293,11 @@ class GMAPI:
     # === Работа с отчетами (Fuel) ===
 
     def _post_with_retry(self, url: str, payload: dict, max_retries: int = 5):
-        """Выполняет POST запрос с повторными попытками при ошибке 429."""
-        # Небольшая задержка перед каждым запросом на генерацию, 
-        # чтобы избежать пачек одновременных вызовов
-        time.sleep(1.5)
-        
-        for attempt in range(max_retries):
-            try:
-                response = requests.post(url, json=payload, timeout=30)
-                if response.status_code == 429:
-                    wait_time = (2 ** attempt) + 1
-                    logger.warning(f"Rate limit hit (429). Retrying in {wait_time}s... (Attempt {attempt+1}/{max_retries})")
-                    time.sleep(wait_time)
-                    continue
-                
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 429 and attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) + 1
-                    time.sleep(wait_time)
-                    continue
-                raise e
-        return None
+        """Выполняет POST запрос на генерацию отчета с повторными попытками."""
+        # Темп генераций держит общий token bucket, а не фиксированная пауза перед каждой
+        return self._request_with_retry(
+            "POST", url, max_retries, limiter=self.report_bucket, json=payload, timeout=30
+        )
 
     def generate_fuel_report(self, tracker_ids: list[int], from_dt: str, to_dt: str):
         """
@@ -244,18 +353,8 @@ class GMAPI:
             "report_id": report_id,
             "locale": "ru"
         }
-        # Для статуса тоже добавим легкую обработку 429, так как поллинг бывает частым
-        for attempt in range(3):
-            try:
-                response = requests.get(url, params=params, timeout=10)
-                if response.status_code == 429:
-                    time.sleep(2)
-                    continue
-                response.raise_for_status()
-                return response.json()
-            except:
-                if attempt == 2: raise
-                time.sleep(1)
+        # Поллинг бывает частым, поэтому 429 здесь вполне ожидаем
+        return self._request_with_retry("GET", url, params=params, timeout=10)
 
     def retrieve_report(self, report_id: int):
         """Скачивает готовый отчет"""
@@ -264,18 +363,7 @@ class GMAPI:
             "hash": self.api_key,
             "report_id": report_id
         }
-        # Аналогично для скачивания
-        for attempt in range(3):
-            try:
-                response = requests.get(url, params=params, timeout=20)
-                if response.status_code == 429:
-                    time.sleep(2)
-                    continue
-                response.raise_for_status()
-                return response.json()
-            except:
-                if attempt == 2: raise
-                time.sleep(1)
+        return self._request_with_retry("GET", url, params=params, timeout=20)
 
 
     def generate_trip_report(self, tracker_ids: list[int], from_dt: str, to_dt: str):
@@ -318,10 +406,22 @@ class GMAPI:
         Ожидание готовности отчета (поллинг).
         Возвращает итоговый статус или вызывает ошибку по таймауту.
         """
-        start_time = time.time()
-        while time.time() - start_time < timeout:
+        # monotonic - переводы системных часов не ломают дедлайн
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+        interval = 0.5
+        while time.monotonic() < deadline:
             status = self.get_report_status(report_id)
-            if status and status.get("success") and status.get("percent_ready") == 100:
+            percent = (status or {}).get("percent_ready") or 0
+            if status and status.get("success") and percent == 100:
                 return status
-            time.sleep(3) # Чуть увеличим паузу между проверками
+            # Быстрые отчеты забираем почти сразу, на долгих - реже дергаем API.
+            # Если сервер отдает прогресс, оцениваем оставшееся время по нему
+            wait = interval
+            if percent > 0:
+                elapsed = time.monotonic() - start_time
+                eta = elapsed * (100 - percent) / percent
+                wait = min(max(eta / 4, 0.5), 10)
+            time.sleep(min(wait, max(deadline - time.monotonic(), 0)))
+            interval = min(interval * 1.5, 10)
         raise TimeoutError(f"Report {report_id} generation timed out")